@@ -2,11 +2,40 @@ from nxc.connection import connection
 from nxc.logger import NXCAdapter
 from nxc.helpers.logger import highlight
 from pyNfsClient import Portmap, Mount, NFSv3, NFS_PROGRAM, NFS_V3, ACCESS3_READ, ACCESS3_MODIFY, ACCESS3_EXECUTE, NFSSTAT3
-import re
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections import OrderedDict
+from itertools import chain
+from queue import Empty, Queue
+from threading import Lock
 import uuid
-import math
 import os
 
+# READDIRPLUS reply sizes, keep the maxcount:dircount ratio at roughly 8:1 as the attributes and handles take about seven
+# times the space of the names (see the libnfs readdirplus benchmarks).
+# Do not raise maxcount: pyNfsClient unpacks the entry chain recursively with about three frames per entry, and a 65536 byte
+# reply of small entries exceeds the default recursion limit (tests/test_nfs.py decodes a full reply).
+READDIRPLUS_DIRCOUNT = 4096
+READDIRPLUS_MAXCOUNT = 32768
+
+# Number of directories listed concurrently by list_dir, each worker needs its own NFS connection and with it a reserved source port
+LIST_DIR_WORKERS = 4
+
+# Maximum number of ACCESS results kept by get_permissions
+PERM_CACHE_SIZE = 65536
+
+# Directory entries that are never listed
+SKIP_NAMES = frozenset((b".", b".."))
+
+# (read, write, execute) -> "rwx" style permission string
+PERM_TABLE = {(r, w, x): f"{'r' if r else '-'}{'w' if w else '-'}{'x' if x else '-'}" for r in (False, True) for w in (False, True) for x in (False, True)}
+
+SIZE_UNITS = ("B", "KB", "MB", "GB", "TB", "PB", "EB", "ZB", "YB")
+SIZE_DIVISORS = tuple(1 << (10 * i) for i in range(len(SIZE_UNITS)))
+
+
+class NFSListingDenied(Exception):
+    """Raised when the NFS server refuses to list a directory or read a file"""
+
 
 class nfs(connection):
     def __init__(self, args, db, host):
@@ -14,6 +43,9 @@ class nfs(connection):
         self.port = 111
         self.portmap = None
         self.mnt_port = None
+        self.nfs_port = None
+        self.nfs_connections = []  # Connections of the list_dir workers, including self.nfs3
+        self.nfs_pool = None  # Idle connections of the list_dir workers
         self.mount = None
         self.auth = {
             "flavor": 1,
@@ -22,6 +54,9 @@ class nfs(connection):
             "gid": 0,
             "aux_gid": [],
         }
+        self.perm_cache = OrderedDict()  # (uid, file handle) -> (read, write, execute), least recently used first
+        self.perm_cache_lock = Lock()  # The list_dir workers share the cache
+        self.exports = None  # (share paths, access lists) once fetched
         connection.__init__(self, args, db, host)
 
     def proto_logger(self):
@@ -54,6 +89,12 @@ class nfs(connection):
             return False
         return True
 
+    def get_nfs_port(self):
+        """Returns the NFS port, looked up on first use and reused by all commands on this connection"""
+        if self.nfs_port is None:
+            self.nfs_port = self.portmap.getport(NFS_PROGRAM, NFS_V3)
+        return self.nfs_port
+
     def enum_host_info(self):
         try:
             # Dump all registered programs
@@ -79,74 +120,170 @@ class nfs(connection):
         except Exception as e:
             self.logger.fail(f"Error during disconnect: {e}")
 
-    def list_dir(self, file_handle, path, recurse=1):
-        """Process entries in NFS directory recursively with UID autodection"""
-        def process_entries(entries, path, uid, recurse):
+    def list_dir(self, executor, file_handle, path, recurse=1):
+        """Yields entries of the NFS directory tree depth first, while the directories are listed ahead on the executor's worker threads with UID autodection"""
+        submitted = []
+        auths = {}  # uid -> auth, shared by all directories and entries owned by the same UID
+
+        def get_auth(uid):
+            """Returns the auth for the autodetected UID, built once per UID instead of once per directory"""
+            if uid not in auths:
+                auths[uid] = dict(self.auth, uid=uid)
+            return auths[uid]
+
+        def submit(dir_handle, path, recurse):
+            """Queues the listing of a directory, its future takes the directory's place in the parent's contents"""
+            future = executor.submit(list_single_dir, dir_handle, path, recurse)
+            submitted.append(future)
+            return future
+
+        def process_entries(nfs3, auth, entries, path, recurse, contents):
+            """Walks the linked list of directory entries into the contents, returns the cookie of the last entry"""
+            cookie = 0
+            while entries:
+                # Entries are chained through a zero or one element list
+                entry = entries[0]
+                entries = entry["nextentry"]
+                cookie = entry["cookie"]  # Advances past broken entries too, so the next page doesn't repeat them
+                if "name" not in entry or entry["name"] in SKIP_NAMES:
+                    continue
+
+                item_path = f'{path}/{entry["name"].decode("utf-8", errors="backslashreplace")}'  # Constructing file path
+                if not entry.get("name_handle", {}).get("present", False):
+                    # Servers may omit the handle, e.g. for mount points, without it the entry can't be inspected
+                    self.logger.debug(f"Skipping {item_path}, the server returned no file handle")
+                    continue
+
+                try:
+                    entry_handle = entry["name_handle"]["handle"]["data"]
+
+                    # Reuse the attributes READDIRPLUS already returned, only fall back to GETATTR if the server omitted them
+                    has_attributes = entry.get("name_attributes", {}).get("present", False)
+                    attributes = entry["name_attributes"]["attributes"] if has_attributes else nfs3.getattr(entry_handle, auth=auth)["attributes"]
+                    is_dir = attributes["type"] == 2  # Entry type shows file format. 1 is file, 2 is folder.
+
+                    if is_dir and recurse > 1:  # Recursive directory listing
+                        contents.append(submit(entry_handle, item_path, recurse - 1))
+                    else:
+                        # Directories on the last level are listed as themselves with the UID of their owner, without listing them
+                        entry_auth = get_auth(attributes["uid"]) if is_dir else auth
+                        read_perm, write_perm, exec_perm = self.get_permissions(entry_handle, entry_auth, nfs3)
+                        if is_dir:
+                            contents.append({"path": f"{item_path}/", "read": read_perm, "write": write_perm, "execute": exec_perm, "filesize": "-", "uid": attributes["uid"]})
+                        else:
+                            contents.append({"path": item_path, "read": read_perm, "write": write_perm, "execute": exec_perm, "filesize": convert_size(attributes["size"]), "uid": attributes["uid"]})
+                except Exception as e:
+                    # A broken entry only costs its own row, the rest of the page is still listed
+                    self.logger.debug(f"Error on Listing Entry {item_path} for NFS Shares: {self.host}:{self.port} {e}")
+            return cookie
+
+        def list_single_dir(dir_handle, path, recurse):
+            """Lists a single directory, returns its contents with futures in place of the subdirectories"""
+            nfs3 = self.get_nfs_connection()
             try:
-                contents = []
-                for entry in entries:
-                    if "name" in entry and entry["name"] not in [b".", b".."]:
-                        item_path = f'{path}/{entry["name"].decode("utf-8")}'  # Constructing file path
-                        if entry.get("name_attributes", {}).get("present", False):
-                            if entry["name_attributes"]["attributes"]["type"] == 2 and recurse > 0:  # Recursive directory listing. Entry type shows file format. 1 is file, 2 is folder.
-                                dir_handle = entry["name_handle"]["handle"]["data"]
-                                contents += self.list_dir(dir_handle, item_path, recurse=recurse - 1)
-                            else:
-                                file_handle = entry["name_handle"]["handle"]["data"]
-                                attrs = self.nfs3.getattr(file_handle, auth=self.auth)
-                                file_size = attrs["attributes"]["size"]
-                                file_size = convert_size(file_size)
-                                uid = attrs["attributes"]["uid"]
-                                read_perm, write_perm, exec_perm = self.get_permissions(entry["name_handle"]["handle"]["data"])
-                                contents.append({"path": item_path, "read": read_perm, "write": write_perm, "execute": exec_perm, "filesize": file_size, "uid": uid})
-
-                    if entry["nextentry"]:
-                        # Processing next entries recursively
-                        contents += process_entries(entry["nextentry"], path, uid, recurse)
+                attrs = nfs3.getattr(dir_handle, auth=self.auth)
+                auth = get_auth(attrs["attributes"]["uid"])
 
-                return contents
-            except Exception as e:
-                self.logger.debug(f"Error on Listing Entries for NFS Shares: {self.host}:{self.port} {e}")
+                if recurse == 0:  # Only reached if the listing itself starts at depth 0, deeper directories stop in process_entries
+                    read_perm, write_perm, exec_perm = self.get_permissions(dir_handle, auth, nfs3)
+                    return [{"path": f"{path}/", "read": read_perm, "write": write_perm, "execute": exec_perm, "filesize": "-", "uid": auth["uid"]}]
 
-        attrs = self.nfs3.getattr(file_handle, auth=self.auth)
-        self.auth["uid"] = attrs["attributes"]["uid"]
+                # Page through the directory with a large reply size, so big directories need as few round trips as possible.
+                # pyNfsClient str()-encodes the cookie verifier, so we always send the zero verifier and stop if a server rejects it.
+                contents = []
+                cookie = 0
+                eof = False
+                while not eof:
+                    items = nfs3.readdirplus(dir_handle, cookie=cookie, cookie_verf="\x00" * 8, dircount=READDIRPLUS_DIRCOUNT, maxcount=READDIRPLUS_MAXCOUNT, auth=auth)
+                    if "resfail" in items:
+                        # Only a failing first page means the directory can't be listed, later pages can fail on e.g. the cookie verifier
+                        if cookie == 0:
+                            raise NFSListingDenied("Insufficient Permissions")
+                        self.logger.fail(f"Listing of {path} stopped early: {NFSSTAT3.get(items['status'], items['status'])}")
+                        break
+
+                    entries = items["resok"]["reply"]["entries"]
+                    eof = items["resok"]["reply"]["eof"]
+                    last_cookie = process_entries(nfs3, auth, entries, path, recurse, contents)
+
+                    # Stop if the server did not make any progress, instead of looping forever
+                    if not entries or last_cookie == cookie:
+                        break
+                    cookie = last_cookie
 
-        if recurse == 0:
-            read_perm, write_perm, exec_perm = self.get_permissions(file_handle)
-            return [{"path": f"{path}/", "read": read_perm, "write": write_perm, "execute": exec_perm, "filesize": "-", "uid": self.auth["uid"]}]
+                return contents
+            finally:
+                self.nfs_pool.put(nfs3)
 
-        items = self.nfs3.readdirplus(file_handle, auth=self.auth)
-        if "resfail" in items:
-            raise Exception("Insufficient Permissions")
-        else:
-            entries = items["resok"]["reply"]["entries"]
+        # Subdirectories are queued as soon as they are found, so several listings are in flight while the
+        # results are yielded in the same depth first order as a sequential walk
+        try:
+            stack = [iter(submit(file_handle, path, recurse).result())]  # Failing on the share itself is reported by the caller
+            while stack:
+                item = next(stack[-1], None)
+                if item is None:
+                    stack.pop()
+                elif isinstance(item, Future):
+                    try:
+                        stack.append(iter(item.result()))
+                    except Exception as e:
+                        # Failing subdirectories are skipped
+                        self.logger.debug(f"Error on Listing Entries for NFS Shares: {self.host}:{self.port} {e}")
+                else:
+                    yield item
+        finally:
+            for future in submitted:
+                future.cancel()
 
-        return process_entries(entries, path, self.auth["uid"], recurse)
+    def get_nfs_connection(self):
+        """Takes an idle NFS connection of the listing workers or opens a new one, pyNfsClient connections can't be shared between threads"""
+        try:
+            return self.nfs_pool.get_nowait()
+        except Empty:
+            nfs3 = NFSv3(self.host, self.get_nfs_port(), self.args.nfs_timeout, self.auth)
+            nfs3.connect()
+            self.nfs_connections.append(nfs3)
+            return nfs3
+
+    def get_exports(self):
+        """Returns the share paths and their access lists, the export list is only fetched once per connection"""
+        if self.exports is None:
+            export_nodes = self.mount.export()
+            self.exports = (self.export_dirs(export_nodes), self.export_info(export_nodes))
+        return self.exports
+
+    def export_dirs(self, export_nodes):
+        """Collects the share paths by walking the linked list of export nodes"""
+        shares = []
+        while export_nodes:
+            node = export_nodes[0]
+            shares.append(node.ex_dir.decode(errors="backslashreplace"))
+            export_nodes = node.ex_next
+        return shares
 
     def export_info(self, export_nodes):
         """Enumerates all NFS shares and their access range"""
         networks = []
-        for node in export_nodes:
+        while export_nodes:
+            node = export_nodes[0]
 
             # Collect the names of the groups associated with this export node
-            group_names = self.group_names(node.ex_groups)
-            networks.append(group_names)
+            networks.append(self.group_names(node.ex_groups))
 
-            # If there are more export nodes, process them recursively. More than one share.
-            if node.ex_next:
-                networks.extend(self.export_info(node.ex_next))
+            # Continue with the next export node, if there is more than one share
+            export_nodes = node.ex_next
 
         return networks
 
     def group_names(self, groups):
         """Enumerates all access range of the share(s)"""
         result = []
-        for group in groups:
-            result.append(group.gr_name.decode())
+        while groups:
+            group = groups[0]
+            result.append(group.gr_name.decode(errors="backslashreplace"))
 
-            # If there are more IP's, process them recursively.
-            if group.gr_next:
-                result.extend(self.group_names(group.gr_next))
+            # Continue with the next IP, if there is more than one
+            groups = group.gr_next
 
         return result
 
@@ -154,15 +291,10 @@ class nfs(connection):
         self.logger.display("Enumerating NFS Shares")
         try:
             # Connect to NFS
-            nfs_port = self.portmap.getport(NFS_PROGRAM, NFS_V3)
-            self.nfs3 = NFSv3(self.host, nfs_port, self.args.nfs_timeout, self.auth)
+            self.nfs3 = NFSv3(self.host, self.get_nfs_port(), self.args.nfs_timeout, self.auth)
             self.nfs3.connect()
 
-            output_export = str(self.mount.export())
-            networks = self.export_info(self.mount.export())
-
-            reg = re.compile(r"ex_dir=b'([^']*)'")  # Get share names
-            shares = list(reg.findall(output_export))
+            shares, networks = self.get_exports()
 
             # Mount shares and check permissions
             self.logger.highlight(f"{'UID':<11}{'Perms':<9}{'Storage Usage':<17}{'Share':<30} {'Access List':<15}")
@@ -176,18 +308,25 @@ class nfs(connection):
                         continue
                     file_handle = mnt_info["mountinfo"]["fhandle"]
 
-                    info = self.nfs3.fsstat(file_handle, self.auth)
-                    free_space = info["resok"]["fbytes"]
-                    total_space = info["resok"]["tbytes"]
-                    used_space = total_space - free_space
-
-                    # Autodetectting the uid needed for the share
+                    # Autodetectting the uid needed for the share, kept out of self.auth so every share is mounted with the same UID
                     attrs = self.nfs3.getattr(file_handle, auth=self.auth)
-                    self.auth["uid"] = attrs["attributes"]["uid"]
-
-                    read_perm, write_perm, exec_perm = self.get_permissions(file_handle)
-                    self.mount.umnt(self.auth)
-                    self.logger.highlight(f"{self.auth['uid']:<11}{'r' if read_perm else '-'}{'w' if write_perm else '-'}{('x' if exec_perm else '-'):<7}{convert_size(used_space)}/{convert_size(total_space):<9} {share:<30} {', '.join(network) if network else 'No network':<15}")
+                    share_auth = dict(self.auth, uid=attrs["attributes"]["uid"])
+
+                    # Check permissions before the storage usage, so they are still shown if FSSTAT fails
+                    read_perm, write_perm, exec_perm = self.get_permissions(file_handle, share_auth)
+
+                    try:
+                        info = self.nfs3.fsstat(file_handle, share_auth)
+                        free_space = info["resok"]["fbytes"]
+                        total_space = info["resok"]["tbytes"]
+                        used_size = convert_size(total_space - free_space)
+                        total_size = convert_size(total_space)
+                    except Exception as e:
+                        self.logger.debug(f"Error getting storage usage of share {share}: {e}")
+                        used_size = total_size = "-"
+
+                    self.mount.umnt(share_auth)
+                    self.logger.highlight(f"{share_auth['uid']:<11}{PERM_TABLE[read_perm, write_perm, exec_perm]:<9}{used_size}/{total_size:<9} {share:<30} {', '.join(network) if network else 'No network':<15}")
                 except Exception as e:
                     self.logger.fail(f"Failed to list share: {share} - {e}")
 
@@ -196,33 +335,44 @@ class nfs(connection):
         finally:
             self.nfs3.disconnect()
 
-    def get_permissions(self, file_handle):
-        """Check permissions for the file handle"""
-        try:
-            read_perm = self.nfs3.access(file_handle, ACCESS3_READ, self.auth).get("resok", {}).get("access", 0) is ACCESS3_READ
-        except Exception:
-            read_perm = False
-        try:
-            write_perm = self.nfs3.access(file_handle, ACCESS3_MODIFY, self.auth).get("resok", {}).get("access", 0) is ACCESS3_MODIFY
-        except Exception:
-            write_perm = False
+    def get_permissions(self, file_handle, auth=None, nfs3=None):
+        """Check read, write and execute permissions for the file handle with a single ACCESS call, cached per UID"""
+        auth = auth or self.auth
+        nfs3 = nfs3 or self.nfs3
+        key = (auth["uid"], file_handle)
+        with self.perm_cache_lock:
+            if key in self.perm_cache:
+                self.perm_cache.move_to_end(key)
+                return self.perm_cache[key]
+
         try:
-            exec_perm = self.nfs3.access(file_handle, ACCESS3_EXECUTE, self.auth).get("resok", {}).get("access", 0) is ACCESS3_EXECUTE
+            res = nfs3.access(file_handle, ACCESS3_READ | ACCESS3_MODIFY | ACCESS3_EXECUTE, auth)
+            granted = res.get("resok", {}).get("access", 0)
         except Exception:
-            exec_perm = False
-        return read_perm, write_perm, exec_perm
+            return False, False, False
+        permissions = (bool(granted & ACCESS3_READ), bool(granted & ACCESS3_MODIFY), bool(granted & ACCESS3_EXECUTE))
+
+        # Least recently used results are dropped, so listing huge shares doesn't keep one entry per file
+        with self.perm_cache_lock:
+            self.perm_cache[key] = permissions
+            if len(self.perm_cache) > PERM_CACHE_SIZE:
+                self.perm_cache.popitem(last=False)
+        return permissions
 
     def enum_shares(self):
+        executor = None
         try:
-            nfs_port = self.portmap.getport(NFS_PROGRAM, NFS_V3)
-            self.nfs3 = NFSv3(self.host, nfs_port, self.args.nfs_timeout, self.auth)
+            self.nfs3 = NFSv3(self.host, self.get_nfs_port(), self.args.nfs_timeout, self.auth)
             self.nfs3.connect()
 
+            # The listing workers share these connections for all shares, starting with the main one
+            self.nfs_connections = [self.nfs3]
+            self.nfs_pool = Queue()
+            self.nfs_pool.put(self.nfs3)
+            executor = ThreadPoolExecutor(max_workers=LIST_DIR_WORKERS)
+
             # Mounting NFS Shares
-            output_export = str(self.mount.export())
-            reg = re.compile(r"ex_dir=b'([^']*)'")
-            shares = list(reg.findall(output_export))
-            networks = self.export_info(self.mount.export())
+            shares, networks = self.get_exports()
 
             self.logger.display("Enumerating NFS Shares Directories")
             for share, network in zip(shares, networks):
@@ -234,28 +384,35 @@ class nfs(connection):
                         continue
 
                     fhandle = mount_info["mountinfo"]["fhandle"]
-                    contents = self.list_dir(fhandle, share, self.args.enum_shares)
+                    contents = self.list_dir(executor, fhandle, share, self.args.enum_shares)
+                    first_content = next(contents, None)  # Raises if the share itself can't be listed
 
                     self.logger.success(share)
-                    if contents:
+                    if first_content:
                         self.logger.highlight(f"{'UID':<11}{'Perms':<9}{'File Size':<15}{'File Path':<45} {'Access List':<15}")
                         self.logger.highlight(f"{'---':<11}{'-----':<9}{'---------':<15}{'---------':<45} {'-----------':<15}")
+                        contents = chain((first_content,), contents)
                     for content in contents:
-                        self.logger.highlight(f"{content['uid']:<11}{'r' if content['read'] else '-'}{'w' if content['write'] else '-'}{'x' if content['execute'] else '-':<7}{content['filesize']:<14} {content['path']:<45} {', '.join(network) if network else 'No network':<15}")
+                        self.logger.highlight(f"{content['uid']:<11}{PERM_TABLE[content['read'], content['write'], content['execute']]:<9}{content['filesize']:<14} {content['path']:<45} {', '.join(network) if network else 'No network':<15}")
+                except NFSListingDenied:
+                    self.logger.fail(f"{share} - Insufficient Permissions for share listing")
                 except Exception as e:
-                    if "RPC_AUTH_ERROR: AUTH_REJECTEDCRED" in str(e):
+                    # pyNfsClient reports RPC auth failures as plain exceptions, so the message is all there is to match on
+                    error = str(e)
+                    if "RPC_AUTH_ERROR: AUTH_REJECTEDCRED" in error:
                         self.logger.fail(f"{share} - RPC Access denied")
-                    elif "RPC_AUTH_ERROR: AUTH_TOOWEAK" in str(e):
+                    elif "RPC_AUTH_ERROR: AUTH_TOOWEAK" in error:
                         self.logger.fail(f"{share} - Kerberos authentication required")
-                    elif "Insufficient Permissions" in str(e):
-                        self.logger.fail(f"{share} - Insufficient Permissions for share listing")
                     else:
                         self.logger.exception(f"{share} - {e}")
         except Exception as e:
             self.logger.debug(f"Error on Listing NFS Shares Directories: {self.host}:{self.port} {e}")
             self.logger.debug("It is probably unknown format or can not access as anonymously.")
         finally:
-            self.nfs3.disconnect()
+            if executor:
+                executor.shutdown(cancel_futures=True)
+            for nfs3 in self.nfs_connections:
+                nfs3.disconnect()
 
     def get_file(self):
         """Downloads a file from the NFS share"""
@@ -270,8 +427,7 @@ class nfs(connection):
         self.logger.display(f"Downloading {remote_file_path} to {local_file_path}")
         try:
             # Connect to NFS
-            nfs_port = self.portmap.getport(NFS_PROGRAM, NFS_V3)
-            self.nfs3 = NFSv3(self.host, nfs_port, self.args.nfs_timeout, self.auth)
+            self.nfs3 = NFSv3(self.host, self.get_nfs_port(), self.args.nfs_timeout, self.auth)
             self.nfs3.connect()
 
             # Mount the NFS share
@@ -296,7 +452,7 @@ class nfs(connection):
                     file_data = self.nfs3.read(file_handle, offset, auth=self.auth)
 
                     if "resfail" in file_data:
-                        raise Exception("Insufficient Permissions")
+                        raise NFSListingDenied("Insufficient Permissions")
 
                     else:
                         # Get the data and append it to the total file data
@@ -336,8 +492,7 @@ class nfs(connection):
         self.logger.display(f"Uploading from {local_file_path} to {remote_file_path}")
         try:
             # Connect to NFS
-            nfs_port = self.portmap.getport(NFS_PROGRAM, NFS_V3)
-            self.nfs3 = NFSv3(self.host, nfs_port, self.args.nfs_timeout, self.auth)
+            self.nfs3 = NFSv3(self.host, self.get_nfs_port(), self.args.nfs_timeout, self.auth)
             self.nfs3.connect()
 
             # Mount the NFS share to create the file
@@ -393,8 +548,5 @@ class nfs(connection):
 def convert_size(size_bytes):
     if size_bytes == 0:
         return "0B"
-    size_name = ("B", "KB", "MB", "GB", "TB", "PB", "EB", "ZB", "YB")
-    i = int(math.floor(math.log(size_bytes, 1024)))
-    p = math.pow(1024, i)
-    s = round(size_bytes / p, 1)
-    return f"{s}{size_name[i]}"
+    i = min((size_bytes.bit_length() - 1) // 10, len(SIZE_UNITS) - 1)
+    return f"{size_bytes / SIZE_DIVISORS[i]:.1f}{SIZE_UNITS[i]}"
@@ -0,0 +1,213 @@
+import os
+import random
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+
+import pytest
+from pyNfsClient.pack import nfs_pro_v3Unpacker
+
+import nxc
+from nxc.loaders.protocolloader import ProtocolLoader
+
+
+@pytest.fixture(scope="session")
+def nfs_protocol():
+    return ProtocolLoader().load_protocol(os.path.join(os.path.dirname(nxc.__file__), "protocols", "nfs.py"))
+
+
+def readdirplus_reply(maxcount):
+    """Builds a READDIRPLUS reply filled up to maxcount with the smallest entries a server can send"""
+    header = struct.pack("!LL8s", 0, 0, b"\x00" * 8)  # NFS3_OK, no directory attributes, cookie verifier
+    footer = struct.pack("!LL", 0, 1)  # No further entries, eof
+    fattr = struct.pack("!LLLLLQQLLQQLLLLLL", 1, 0o644, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0)
+
+    def entry(i):
+        return struct.pack("!LQL4sQL", 1, i, 1, b"a", i, 1) + fattr + struct.pack("!LL8s", 1, 8, i.to_bytes(8, "big"))
+
+    count = (maxcount - len(header) - len(footer)) // len(entry(0))
+    return header + b"".join(entry(i) for i in range(count)) + footer, count
+
+
+def test_readdirplus_maxcount_reply_unpacks(nfs_protocol):
+    # pyNfsClient unpacks the entry chain recursively, so a full reply must stay within the recursion limit of a list_dir worker
+    reply, count = readdirplus_reply(nfs_protocol.READDIRPLUS_MAXCOUNT)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        res = executor.submit(nfs_pro_v3Unpacker(reply).unpack_readdirplus3res).result()
+
+    unpacked = 0
+    entries = res["resok"]["reply"]["entries"]
+    while entries:
+        unpacked += 1
+        entries = entries[0]["nextentry"]
+    assert unpacked == count
+    assert res["resok"]["reply"]["eof"]
+
+
+class FakeNFSv3:
+    """Serves a directory tree over the parts of the pyNfsClient NFSv3 API used by list_dir, a few entries per READDIRPLUS page"""
+
+    page_size = 3
+
+    def __init__(self, tree, opened, failing_pages=()):
+        self.tree = tree  # handle -> (attributes, [(name, handle), ...])
+        self.opened = opened
+        self.failing_pages = failing_pages  # (handle, cookie) pairs answered with a resfail
+        opened.append(self)
+
+    def connect(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def getattr(self, file_handle, auth=None):
+        return {"status": 0, "attributes": self.tree[file_handle][0]}
+
+    def access(self, file_handle, access, auth=None):
+        return {"status": 0, "resok": {"access": access}}
+
+    def readdirplus(self, dir_handle, cookie=0, cookie_verf="0", dircount=4096, maxcount=32768, auth=None):
+        time.sleep(random.random() / 1000)  # Shuffle the order in which the workers finish
+        if (dir_handle, cookie) in self.failing_pages:
+            return {"status": 13, "resfail": {}}
+
+        children = [(b".", dir_handle), (b"..", dir_handle), *self.tree[dir_handle][1]]
+        page = children[cookie:cookie + self.page_size]
+        entries = []
+        for offset, (name, handle) in reversed(list(enumerate(page))):
+            # Children without a handle are sent without one, children missing from the tree without attributes
+            entries = [{
+                "cookie": cookie + offset + 1,
+                "name": name,
+                "name_attributes": {"present": True, "attributes": self.tree[handle][0]} if handle in self.tree else {"present": False},
+                "name_handle": {"present": True, "handle": {"data": handle}} if handle is not None else {"present": False},
+                "nextentry": entries,
+            }]
+        return {"status": 0, "resok": {"reply": {"entries": entries, "eof": cookie + self.page_size >= len(children)}}}
+
+
+def build_tree(spec, handle=b"/"):
+    """Turns nested dicts (directories) and ints (file sizes) into the handle -> (attributes, children) map of FakeNFSv3"""
+    tree = {}
+    if isinstance(spec, int):
+        tree[handle] = ({"type": 1, "uid": 1000, "size": spec}, [])
+        return tree
+    children = []
+    for name, child in spec.items():
+        child_handle = handle + name.encode() + b"/"
+        children.append((name.encode(), child_handle))
+        tree.update(build_tree(child, child_handle))
+    tree[handle] = ({"type": 2, "uid": 1000, "size": 4096}, children)
+    return tree
+
+
+def sequential_walk(spec, path, recurse):
+    """Lists the tree one directory after another, the reference order for list_dir"""
+    if recurse == 0:
+        return [f"{path}/"]
+    paths = []
+    for name, child in spec.items():
+        if isinstance(child, int):
+            paths.append(f"{path}/{name}")
+        elif recurse > 1:
+            paths.extend(sequential_walk(child, f"{path}/{name}", recurse - 1))
+        else:
+            paths.append(f"{path}/{name}/")
+    return paths
+
+
+TREE = {
+    "a": 1,
+    "d": {f"f{i}": i for i in range(5)} | {"sub": {"deep": {"x": 1}, "y": 2}},
+    "e": {},
+    "w": {f"w{i}": {"v": i} for i in range(8)},
+    "z": 3,
+}
+
+
+@pytest.fixture
+def nfs_lister(nfs_protocol, monkeypatch):
+    """Returns a function listing TREE with list_dir, the NFS connections it opened, the failing pages and the served tree"""
+    monkeypatch.setattr(nfs_protocol.connection, "__init__", lambda self, args, db, host: None)
+    tree = build_tree(TREE)
+    opened = []
+    failing_pages = set()
+    monkeypatch.setattr(nfs_protocol, "NFSv3", lambda host, port, timeout, auth: FakeNFSv3(tree, opened, failing_pages))
+
+    def list_tree(recurse):
+        args = SimpleNamespace(nfs_timeout=1)
+        conn = nfs_protocol.nfs(args, None, "host")
+        conn.args = args
+        conn.host = "host"
+        conn.logger = MagicMock()
+        conn.nfs_port = 2049
+        conn.nfs3 = nfs_protocol.NFSv3(conn.host, conn.nfs_port, args.nfs_timeout, conn.auth)
+        conn.nfs_connections = [conn.nfs3]
+        conn.nfs_pool = Queue()
+        conn.nfs_pool.put(conn.nfs3)
+        with ThreadPoolExecutor(max_workers=nfs_protocol.LIST_DIR_WORKERS) as executor:
+            rows = [row["path"] for row in conn.list_dir(executor, b"/", "/share", recurse)]
+        return rows, conn
+
+    return SimpleNamespace(list_tree=list_tree, opened=opened, failing_pages=failing_pages, tree=tree)
+
+
+@pytest.mark.parametrize("recurse", [0, 1, 2, 4])
+def test_list_dir_matches_sequential_walk(nfs_lister, recurse):
+    list_tree = nfs_lister.list_tree
+    expected = sequential_walk(TREE, "/share", recurse)
+    for _ in range(5):
+        assert list_tree(recurse)[0] == expected
+
+
+def test_list_dir_depths(nfs_lister):
+    list_tree = nfs_lister.list_tree
+    assert list_tree(0)[0] == ["/share/"]
+    assert list_tree(1)[0] == ["/share/a", "/share/d/", "/share/e/", "/share/w/", "/share/z"]
+    assert list_tree(2)[0] == [
+        "/share/a",
+        *(f"/share/d/f{i}" for i in range(5)),
+        "/share/d/sub/",
+        *(f"/share/w/w{i}/" for i in range(8)),
+        "/share/z",
+    ]
+
+
+def test_list_dir_keeps_rows_of_failed_continuation_page(nfs_lister):
+    list_tree, failing_pages = nfs_lister.list_tree, nfs_lister.failing_pages
+    failing_pages.add((b"/d/", 3))  # The first page holds ".", ".." and f0
+    rows, conn = list_tree(2)
+    assert rows == ["/share/a", "/share/d/f0", *(f"/share/w/w{i}/" for i in range(8)), "/share/z"]
+    conn.logger.fail.assert_called_once()
+
+
+def test_list_dir_skips_unlistable_subdirectory(nfs_lister):
+    list_tree, failing_pages = nfs_lister.list_tree, nfs_lister.failing_pages
+    failing_pages.add((b"/d/", 0))
+    assert list_tree(2)[0] == ["/share/a", *(f"/share/w/w{i}/" for i in range(8)), "/share/z"]
+
+
+def test_list_dir_unlistable_share(nfs_lister, nfs_protocol):
+    list_tree, failing_pages = nfs_lister.list_tree, nfs_lister.failing_pages
+    failing_pages.add((b"/", 0))
+    with pytest.raises(nfs_protocol.NFSListingDenied):
+        list_tree(1)
+
+
+def test_list_dir_connections_bounded_by_workers(nfs_lister, nfs_protocol):
+    list_tree, opened = nfs_lister.list_tree, nfs_lister.opened
+    for _ in range(5):
+        opened.clear()
+        _, conn = list_tree(4)
+        assert 1 <= len(opened) <= nfs_protocol.LIST_DIR_WORKERS
+        assert conn.nfs_connections == opened
+
+
+def test_list_dir_skips_broken_entries(nfs_lister):
+    # A Latin-1 name, a mount point without a handle and an entry whose GETATTR fails, all on the first page after "." and ".."
+    nfs_lister.tree[b"/"][1][:0] = [(b"caf\xe9", b"/a/"), (b"mnt", None), (b"gone", b"/gone/")]
+    assert nfs_lister.list_tree(1)[0] == ["/share/caf\\xe9", "/share/a", "/share/d/", "/share/e/", "/share/w/", "/share/z"]